@@ -5,19 +5,20 @@ JSON を読み込んで kintone に登録（エラーハンドリング強化版
 """
 import os
 import sys
-import json
 import logging
+import orjson
+import functools
 from pathlib import Path
 
 # modules をパスに追加
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from google.cloud import storage
 from modules.kintone_client import (
     KintoneClient,
     KintoneValidationError,
     KintoneAPIError
 )
+from modules.storage_client import get_bucket
 
 # ロガー設定
 logger = logging.getLogger(__name__)
@@ -27,6 +28,15 @@ logging.basicConfig(
 )
 
 
+@functools.lru_cache(maxsize=1)
+def get_kintone_client() -> KintoneClient:
+    """
+    kintone クライアント取得（環境変数から自動取得）
+    ウォームインスタンスでは初回生成分を再利用する
+    """
+    return KintoneClient()
+
+
 def on_json_finalized(cloud_event):
     """
     Cloud Function エントリーポイント
@@ -39,27 +49,25 @@ def on_json_finalized(cloud_event):
     bucket_name = data["bucket"]
     file_name = data["name"]
     
-    logger.info(f"📝 [Kintone Pusher] Processing: gs://{bucket_name}/{file_name}")
-    
-    # JSON ファイルのみ処理
+    # JSON ファイルのみ処理（GCS / kintone に触れる前に判定）
     if not file_name.lower().endswith(".json"):
         logger.info(f"⏭️ [Kintone Pusher] Skipped: {file_name} (not JSON)")
         return
     
+    logger.info(f"📝 [Kintone Pusher] Processing: gs://{bucket_name}/{file_name}")
+    
     try:
         # 1. GCS から JSON を取得
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(file_name)
+        blob = get_bucket(bucket_name).blob(file_name)
         
         logger.debug(f"GCS からファイルダウンロード: {file_name}")
-        json_text = blob.download_as_text()
-        json_data = json.loads(json_text)
+        # デコードせずバイト列のまま渡す（orjson は UTF-8 バイト列を直接パース）
+        json_data = orjson.loads(blob.download_as_bytes())
         
         logger.info(f"✅ [Kintone Pusher] Loaded JSON: {json_data}")
         
-        # 2. kintone クライアント初期化（環境変数から自動取得）
-        client = KintoneClient()
+        # 2. kintone クライアント取得（環境変数から自動取得）
+        client = get_kintone_client()
         
         # 3. kintone に登録（エラーハンドリング付き）
         try:
@@ -79,7 +87,6 @@ def on_json_finalized(cloud_event):
             error_bucket_name = os.environ.get("ERROR_BUCKET")
             if error_bucket_name:
                 save_error_file(
-                    storage_client,
                     error_bucket_name,
                     file_name,
                     json_data,
@@ -97,7 +104,7 @@ def on_json_finalized(cloud_event):
             # API エラーは再スローして Cloud Functions のリトライ機構を使う
             raise
         
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         logger.error(f"❌ [Kintone Pusher] Invalid JSON: {str(e)}")
         logger.error(f"   File: {file_name}")
         # JSON パースエラーは再送不可
@@ -113,7 +120,6 @@ def on_json_finalized(cloud_event):
 
 
 def save_error_file(
-    storage_client: storage.Client,
     error_bucket_name: str,
     original_file_name: str,
     json_data: dict,
@@ -123,14 +129,13 @@ def save_error_file(
     エラーファイルを保存
     
     Args:
-        storage_client: GCS クライアント
         error_bucket_name: エラーバケット名
         original_file_name: 元のファイル名
         json_data: JSONデータ
         error_message: エラーメッセージ
     """
     try:
-        error_bucket = storage_client.bucket(error_bucket_name)
+        error_bucket = get_bucket(error_bucket_name)
         error_file_name = f"validation_errors/{original_file_name}"
         error_blob = error_bucket.blob(error_file_name)
         
@@ -141,7 +146,7 @@ def save_error_file(
         }
         
         error_blob.upload_from_string(
-            json.dumps(error_data, ensure_ascii=False, indent=2),
+            orjson.dumps(error_data, option=orjson.OPT_INDENT_2),
             content_type="application/json"
         )
         
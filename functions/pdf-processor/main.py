@@ -5,11 +5,13 @@ PDF Processor Cloud Function / Cloud Run
 """
 import os
 import sys
-import json
 import logging
+import threading
+import orjson
 import functions_framework
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # ロギング設定
 logging.basicConfig(level=logging.INFO)
@@ -18,8 +20,149 @@ logger = logging.getLogger(__name__)
 # modules をパスに追加
 sys.path.insert(0, str(Path(__file__).parent.parent.parent))
 
-from google.cloud import storage
-from modules.docai_processor import process_pdf
+from google.api_core.exceptions import PreconditionFailed
+from modules.docai_processor import process_pdf, warm_up
+from modules.storage_client import get_bucket
+
+# Document AI / Gemini のウォームアップはワーカープロセス内で行う
+# main.py は gunicorn が fork する前の親プロセスで import されるため、import 時に
+# gRPC チャネルを作ると fork 後のワーカーでは使えない（GRPC_ENABLE_FORK_SUPPORT 無効時）
+_warm_up_lock = threading.Lock()
+_warm_up_started = False
+
+
+def _start_warm_up() -> None:
+    """
+    最初のリクエスト時に一度だけ、バックグラウンドでウォームアップを開始する
+    リクエスト側の PDF ダウンロード等と並行して接続を確立する
+    """
+    global _warm_up_started
+    if _warm_up_started or not os.environ.get("K_SERVICE"):
+        return
+    with _warm_up_lock:
+        if _warm_up_started:
+            return
+        _warm_up_started = True
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+# バッチ再処理時の並列数（Document AI / Gemini は I/O 待ちが主体なのでスレッドで並列化）
+BATCH_MAX_WORKERS = int(os.environ.get("BATCH_MAX_WORKERS", "8"))
+
+
+def _is_reusable(json_blob, source_generation: str) -> bool:
+    """
+    既存の出力 JSON が、同じ世代の入力 PDF から抽出に成功した結果か判定
+
+    vendor は kintone-pusher の必須項目で、これが無い結果からは kintone レコードが
+    作られていない。そのため抽出失敗扱いとして再処理・置き換えてよい
+    """
+    # 読み込み自体の失敗は再スローする（成功済みの JSON を誤って置き換えないため）
+    data = json_blob.download_as_bytes(if_generation_match=json_blob.generation)
+    try:
+        existing = orjson.loads(data)
+    except orjson.JSONDecodeError as e:
+        # 壊れた JSON は kintone-pusher でも登録されないので置き換えてよい
+        logger.warning(f"⚠️ [PDF Processor] 既存 JSON が不正: {json_blob.name}: {e}")
+        return False
+    if not isinstance(existing, dict):
+        return False
+
+    # source_generation が無いのは世代記録前の JSON（同じ入力とみなす）
+    stored_generation = (existing.get("_metadata") or {}).get("source_generation")
+    if stored_generation is not None and str(stored_generation) != source_generation:
+        return False
+
+    return (
+        (existing.get("_source") or {}).get("status") == "success"
+        and existing.get("vendor") is not None
+    )
+
+
+def process_and_save(bucket_name: str, file_name: str, source_generation=None) -> dict:
+    """
+    PDF を処理して OUTPUT_BUCKET に JSON を保存
+
+    書き込みのたびに kintone-pusher が起動してレコードを作成するため、同じ入力 PDF の
+    成功結果が既にあればスキップする。既存の JSON が別世代の入力（同名で再アップロード）
+    または抽出失敗の結果の場合のみ、読み込んだ世代を条件に置き換える
+
+    Args:
+        bucket_name: 入力バケット名
+        file_name: PDF ファイル名
+        source_generation: 入力 PDF の世代（None の場合は GCS から取得）
+
+    Returns:
+        保存した JSON データ（処理済みでスキップした場合は None）
+    """
+    output_bucket_name = os.environ.get("OUTPUT_BUCKET")
+    if not output_bucket_name:
+        raise ValueError("OUTPUT_BUCKET environment variable is not set")
+
+    if source_generation is None:
+        source_blob = get_bucket(bucket_name).get_blob(file_name)
+        if source_blob is None:
+            raise FileNotFoundError(f"gs://{bucket_name}/{file_name} not found")
+        source_generation = source_blob.generation
+    source_generation = str(source_generation)
+
+    output_bucket = get_bucket(output_bucket_name)
+    json_file_name = file_name.replace(".pdf", ".json")
+    json_blob = output_bucket.blob(json_file_name)
+
+    # 0. 処理済みならスキップ
+    # Web アップロードはファイル名が内容の SHA-256 なので、同じ請求書の再アップロードや
+    # イベント再配信では Document AI / Gemini を呼ばずに済む
+    existing_blob = output_bucket.get_blob(json_file_name)
+    if existing_blob is not None and _is_reusable(existing_blob, source_generation):
+        logger.info(
+            f"⏭️ [PDF Processor] Already processed, skipped: "
+            f"gs://{output_bucket_name}/{json_file_name}"
+        )
+        return None
+
+    # 新規作成、または読み込んだ世代のままの既存 JSON のみ置き換える
+    expected_generation = existing_blob.generation if existing_blob is not None else 0
+
+    # 1. Document AI で処理
+    extracted_data = process_pdf(bucket_name, file_name)
+    logger.info(f"✅ [PDF Processor] Extracted: {extracted_data}")
+    logger.info(f"🔍 [DEBUG] Extracted data keys: {list(extracted_data.keys())}")
+
+    # 2. OUTPUT_BUCKET に JSON 保存
+
+    # メタデータを追加
+    result = {
+        **extracted_data,
+        "_metadata": {
+            "source_file": file_name,
+            "source_bucket": bucket_name,
+            "processor": "pdf-processor",
+            "source_generation": source_generation,
+            "timestamp": datetime.now(timezone.utc),  # orjson が RFC 3339 文字列に変換
+        },
+    }
+
+    # orjson は UTF-8 の bytes を直接返すので、そのままアップロードできる
+    payload = orjson.dumps(result, option=orjson.OPT_INDENT_2)
+    try:
+        json_blob.upload_from_string(
+            payload,
+            content_type="application/json",
+            if_generation_match=expected_generation,
+        )
+    except PreconditionFailed:
+        # 確認後に別のインスタンスが書き込んだ（同時配信）
+        logger.info(
+            f"⏭️ [PDF Processor] JSON written concurrently, skipped: "
+            f"gs://{output_bucket_name}/{json_file_name}"
+        )
+        return None
+    
+    logger.info(f"🔍 [DEBUG] Saved JSON keys: {list(result.keys())}")
+    logger.info(f"🔍 [DEBUG] Saved JSON content: {payload.decode('utf-8')[:500]}")
+    logger.info(f"✅ [PDF Processor] Saved JSON: gs://{output_bucket_name}/{json_file_name}")
+    return result
 
 
 @functions_framework.cloud_event
@@ -28,6 +171,8 @@ def on_file_finalized(cloud_event):
     Cloud Function エントリーポイント
     Eventarc からのイベントをハンドル
     """
+    _start_warm_up()
+
     try:
         # イベントデータのパース
         data = cloud_event.data
@@ -39,47 +184,14 @@ def on_file_finalized(cloud_event):
         bucket_name = data.get("bucket")
         file_name = data.get("name")
 
-        logger.info(f"📄 [PDF Processor] Processing: gs://{bucket_name}/{file_name}")
-
-        # PDF ファイルのみ処理
-        if not file_name.lower().endswith(".pdf"):
+        # PDF ファイルのみ処理（GCS / Document AI に触れる前に判定）
+        if not (file_name or "").lower().endswith(".pdf"):
             logger.info(f"⏭️ [PDF Processor] Skipped: {file_name} (not PDF)")
             return
 
-        # 1. Document AI で処理
-        extracted_data = process_pdf(bucket_name, file_name)
-        logger.info(f"✅ [PDF Processor] Extracted: {extracted_data}")
-        logger.info(f"🔍 [DEBUG] Extracted data keys: {list(extracted_data.keys())}")
-
-        # 2. OUTPUT_BUCKET に JSON 保存
-        output_bucket_name = os.environ.get("OUTPUT_BUCKET")
-        if not output_bucket_name:
-            raise ValueError("OUTPUT_BUCKET environment variable is not set")
-
-        storage_client = storage.Client()
-        output_bucket = storage_client.bucket(output_bucket_name)
-        json_file_name = file_name.replace(".pdf", ".json")
-        json_blob = output_bucket.blob(json_file_name)
-
-        # メタデータを追加
-        result = {
-            **extracted_data,
-            "_metadata": {
-                "source_file": file_name,
-                "source_bucket": bucket_name,
-                "processor": "pdf-processor",
-                "timestamp": datetime.utcnow().isoformat(),
-            },
-        }
+        logger.info(f"📄 [PDF Processor] Processing: gs://{bucket_name}/{file_name}")
 
-        json_blob.upload_from_string(
-            json.dumps(result, ensure_ascii=False, indent=2),
-            content_type="application/json",
-        )
-        
-        logger.info(f"🔍 [DEBUG] Saved JSON keys: {list(result.keys())}")
-        logger.info(f"🔍 [DEBUG] Saved JSON content: {json.dumps(result, ensure_ascii=False, indent=2)[:500]}")
-        logger.info(f"✅ [PDF Processor] Saved JSON: gs://{output_bucket_name}/{json_file_name}")
+        process_and_save(bucket_name, file_name, data.get("generation"))
         logger.info(f"🎉 [PDF Processor] Successfully processed: {file_name}")
 
     except Exception as e:
@@ -87,6 +199,71 @@ def on_file_finalized(cloud_event):
         raise
 
 
+@functions_framework.http
+def on_batch_request(request):
+    """
+    バッチ再処理用 HTTP エントリーポイント
+    複数の PDF をスレッドプールで並列処理する（バックフィル用）
+    処理済み（同じ世代の入力から抽出に成功した JSON が存在する）の PDF はスキップする
+
+    リクエストボディ:
+        {"bucket": "input-bucket", "names": ["a.pdf", "b.pdf", ...]}
+    """
+    _start_warm_up()
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        payload = {}
+    bucket_name = payload.get("bucket")
+    names = payload.get("names")
+
+    # names は文字列のリストのみ受け付ける（文字列単体を1文字ずつ処理しないように）
+    if not isinstance(names, list) or not all(isinstance(n, str) for n in names):
+        logger.error("❌ Invalid batch request: names must be a list of strings")
+        return {"error": "names は PDF ファイル名（文字列）のリストで指定してください"}, 400
+
+    names = [n for n in names if n.lower().endswith(".pdf")]
+
+    if not isinstance(bucket_name, str) or not bucket_name or not names:
+        logger.error("❌ Invalid batch request: missing bucket or names")
+        return {"error": "bucket と names（PDF ファイル名のリスト）を指定してください"}, 400
+
+    logger.info(f"📦 [PDF Processor] Batch processing: {len(names)} files in gs://{bucket_name}")
+
+    processed = []
+    skipped = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(process_and_save, bucket_name, name): name
+            for name in names
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"❌ [PDF Processor] Error: {name}: {str(e)}", exc_info=True)
+                failed.append({"name": name, "error": str(e)})
+                continue
+
+            if result is None:
+                skipped.append(name)
+                continue
+
+            source = result.get("_source", {})
+            if source.get("status") == "error":
+                failed.append({"name": name, "error": source.get("error_message")})
+            else:
+                processed.append(name)
+
+    logger.info(
+        f"🎉 [PDF Processor] Batch finished: "
+        f"成功={len(processed)}, スキップ={len(skipped)}, 失敗={len(failed)}"
+    )
+    return {"processed": processed, "skipped": skipped, "failed": failed}, 200 if not failed else 207
+
+
 if __name__ == "__main__":
     """ローカルテスト用"""
     from dotenv import load_dotenv
@@ -1,19 +1,44 @@
 # modules/docai_processor.py
 import os
 import re
-import json
-import tempfile
+import orjson
+import hashlib
 import logging
-from datetime import datetime
-from decimal import Decimal, InvalidOperation
-from google.cloud import storage, documentai
+import functools
+import threading
+from datetime import date
+from collections import OrderedDict
+from google.cloud import documentai
 from google.api_core.client_options import ClientOptions
-from vertexai.preview.generative_models import GenerativeModel
+from google.protobuf import field_mask_pb2
+from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
 import vertexai
+from modules.storage_client import get_bucket
 
 # ロガー設定
 logger = logging.getLogger(__name__)
 
+# ==== 正規表現（モジュールロード時に一度だけコンパイル） ====
+_CORP_RE = re.compile(r"株式会社|（株）|㈱|\(株\)|有限会社")
+_WS_RE = re.compile(r"\s+")
+# 数字と小数点以外（桁区切りのカンマを含む）を一度に除去
+_NON_NUMERIC_RE = re.compile(r"[^\d.]")
+# Gemini フォールバック: 4項目を1回の走査で拾う
+# 各分岐は先頭文字が重ならず、先読みで文字を消費しないため
+# 項目ごとに個別に re.search した場合と同じ「最初の一致」が得られる
+_FALLBACK_RE = re.compile(
+    r"(?=(?P<vendor>(?:株式|有限)会社[^\s　\n]+))"
+    r"|(?=(?P<total>(?:合計|ご請求金額|総額)[^\d¥￥]*[¥￥]?\s*(?P<total_amount>[\d,]+)))"
+    r"|(?=(?P<subtotal>(?:小計|税抜金額)[^\d¥￥]*[¥￥]?\s*(?P<subtotal_amount>[\d,]+)))"
+    r"|(?=(?P<due_date>(?:支払期限|お支払期日|入金期日)[^\d]*"
+    r"(?P<due_y>\d{4})[年/.\-](?P<due_m>\d{1,2})[月/.\-](?P<due_d>\d{1,2})))"
+)
+
+# OCR誤認識パターン（印影による重複文字）
+_OCR_CORRECTIONS = [
+    (re.compile(r"リンク.*$"), "リンク"),
+]
+
 # ==== ベンダー名正規化 ====
 def normalize_vendor_name(name: str) -> str:
     """
@@ -26,61 +51,45 @@ def normalize_vendor_name(name: str) -> str:
         return name
     
     # 株式会社、（株）、㈱を除去
-    normalized = re.sub(r"株式会社|（株）|㈱|\(株\)|有限会社", "", name)
+    normalized = _CORP_RE.sub("", name)
     
     # OCR誤認識パターンを修正（印影による重複文字）
-    ocr_corrections = {
-        r"リンク.*$": "リンク",
-    }
-    
-    for pattern, replacement in ocr_corrections.items():
-        normalized = re.sub(pattern, replacement, normalized)
+    for pattern, replacement in _OCR_CORRECTIONS:
+        normalized = pattern.sub(replacement, normalized)
     
     # 全角・半角スペースを除去
-    normalized = re.sub(r"\s+", "", normalized)
+    normalized = _WS_RE.sub("", normalized)
     
     logger.debug(f"ベンダー名正規化: '{name}' → '{normalized}'")
     return normalized.strip() if normalized else name
 
 # ==== 共通：数値変換 ====
-def _to_decimal(x):
-    """数値文字列をDecimalに安全変換"""
+def _to_amount(x):
+    """数値文字列を float に安全変換（桁区切り・通貨記号は除去）"""
     if x is None:
         return None
+    s = _NON_NUMERIC_RE.sub("", str(x))
+    if not s:
+        return None
     try:
-        s = str(x)
-        s = re.sub(r"[^\d,\.]", "", s)
-        if not s:
-            return None
-        s = s.replace(",", "")
-        return Decimal(s)
-    except (InvalidOperation, ValueError):
+        # 最終的に float で扱うため Decimal を経由せず直接変換する
+        return float(s)
+    except ValueError:
         return None
 
 
-# ==== Geminiを使用して4項目を抽出 ====
-def extract_with_gemini(text: str, project_id: str) -> dict:
-    """
-    Gemini 2.0 Flashを使用して vendor / subtotal / total / due_date を抽出
-    """
-    fields = {
-        "vendor": None,
-        "subtotal": None,
-        "total": None,
-        "due_date": None,
-    }
-
-    if not text or len(text) < 40:
-        logger.warning("⚠️ テキストが短すぎます")
-        return fields
+# ==== Gemini 抽出プロンプト ====
+# プロンプトに含める OCR テキストの最大文字数（請求書の主要項目は冒頭に集中する）
+PROMPT_TEXT_LIMIT = 2000
+# これより短い OCR テキストは抽出対象外（Gemini もキャッシュも通さない）
+MIN_TEXT_LENGTH = 40
 
-    try:
-        # === Gemini初期化 ===
-        vertexai.init(project=project_id, location="us-central1")
-        model = GenerativeModel("gemini-2.0-flash")
 
-        # === プロンプト ===
-        prompt = f"""
+def build_prompt(text: str) -> str:
+    """
+    請求書テキストから Gemini に渡す抽出プロンプトを組み立てる
+    """
+    return f"""
 以下は請求書のテキストです。
 次の4項目を正確に抽出して、必ずJSONのみで出力してください。
 
@@ -94,7 +103,7 @@ def extract_with_gemini(text: str, project_id: str) -> dict:
 - JSON以外の説明文は出力禁止
 
 テキスト:
-{text[:2000]}
+{text[:PROMPT_TEXT_LIMIT]}
 
 出力フォーマット:
 {{
@@ -104,42 +113,159 @@ def extract_with_gemini(text: str, project_id: str) -> dict:
   "due_date": "YYYY-MM-DD"
 }}
 """
+
+
+# ==== Gemini モデル（プロセス内で一度だけ初期化） ====
+GEMINI_LOCATION = "us-central1"
+GEMINI_MODEL_NAME = "gemini-2.0-flash"
+
+# 構造化出力（JSON モード）: レスポンスをスキーマどおりの JSON に固定する
+GENERATION_CONFIG = GenerationConfig(
+    response_mime_type="application/json",
+    response_schema={
+        "type": "object",
+        "properties": {
+            "vendor": {"type": "string", "nullable": True},
+            "subtotal": {"type": "number", "nullable": True},
+            "total": {"type": "number", "nullable": True},
+            "due_date": {"type": "string", "nullable": True},
+        },
+        "required": ["vendor", "subtotal", "total", "due_date"],
+    },
+)
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def _get_model(project_id: str) -> GenerativeModel:
+    """
+    Gemini モデル取得
+    vertexai.init と GenerativeModel の生成は初回のみ行い、ウォームインスタンスでは再利用する
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                logger.info(f"🤖 Gemini初期化: {GEMINI_MODEL_NAME} ({GEMINI_LOCATION})")
+                vertexai.init(project=project_id, location=GEMINI_LOCATION)
+                _model = GenerativeModel(
+                    GEMINI_MODEL_NAME,
+                    generation_config=GENERATION_CONFIG,
+                )
+    return _model
+
+
+# ==== 抽出結果キャッシュ（OCRテキストのハッシュ → 抽出結果） ====
+# 同一PDFの再アップロード・リトライ時に Gemini を再呼び出ししない
+EXTRACTION_CACHE_SIZE = 256
+
+_extraction_cache = OrderedDict()
+_extraction_cache_lock = threading.Lock()
+
+
+def extract_with_gemini(text: str, project_id: str) -> dict:
+    """
+    Gemini 2.0 Flashを使用して vendor / subtotal / total / due_date を抽出
+    同一OCRテキストの抽出結果はプロセス内でキャッシュする（LRU）
+    """
+    # OCR が空・極端に短い場合はハッシュ計算やモデル初期化の前に打ち切る
+    if not text or len(text) < MIN_TEXT_LENGTH:
+        fields, _ = _extract_with_gemini(text, project_id)
+        return fields
+
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with _extraction_cache_lock:
+        cached = _extraction_cache.get(key)
+        if cached is not None:
+            _extraction_cache.move_to_end(key)
+            logger.info("♻️ Gemini抽出結果をキャッシュから取得")
+            return dict(cached)
+
+    fields, from_gemini = _extract_with_gemini(text, project_id)
+
+    # Gemini から得た結果のみキャッシュする
+    # （Geminiエラー時の正規表現フォールバック結果は、Gemini 復旧後も使われ続けないよう除外）
+    if from_gemini and any(v is not None for v in fields.values()):
+        with _extraction_cache_lock:
+            _extraction_cache[key] = dict(fields)
+            _extraction_cache.move_to_end(key)
+            while len(_extraction_cache) > EXTRACTION_CACHE_SIZE:
+                _extraction_cache.popitem(last=False)
+
+    return fields
+
+
+# ==== Geminiを使用して4項目を抽出 ====
+def _extract_with_gemini(text: str, project_id: str) -> tuple:
+    """
+    Gemini 2.0 Flashを使用して vendor / subtotal / total / due_date を抽出
+
+    Returns:
+        (抽出結果, Gemini の出力から得た結果か)
+        Gemini が失敗し正規表現フォールバックを使った場合・エラー時は False
+    """
+    fields = {
+        "vendor": None,
+        "subtotal": None,
+        "total": None,
+        "due_date": None,
+    }
+    from_gemini = False
+
+    if not text or len(text) < MIN_TEXT_LENGTH:
+        logger.warning("⚠️ テキストが短すぎます")
+        return fields, from_gemini
+
+    try:
+        model = _get_model(project_id)
+        prompt = build_prompt(text)
         response = model.generate_content(prompt)
         raw = (response.text or "").strip()
         logger.info(f"🤖 Gemini raw output: {raw[:300]}")
 
         ai_fields = {}
         if raw:
-            # JSON部分のみ抽出
-            m = re.search(r"\{.*\}", raw, re.S)
-            if m:
-                try:
-                    ai_fields = json.loads(m.group(0))
+            # JSON モードなので本文全体がそのまま JSON（前後の説明文やコードフェンスは付かない）
+            try:
+                parsed = orjson.loads(raw)
+                if isinstance(parsed, dict):
+                    ai_fields = parsed
                     logger.info(f"✅ Gemini parsed: {ai_fields}")
-                except json.JSONDecodeError as e:
-                    logger.warning(f"⚠️ JSON parse failed: {e}")
-                    ai_fields = {}
+                else:
+                    logger.warning(f"⚠️ Unexpected JSON type: {type(parsed).__name__}")
+            except orjson.JSONDecodeError as e:
+                logger.warning(f"⚠️ JSON parse failed: {e}")
 
         # === フォールバック（Geminiが失敗した場合） ===
-        if not ai_fields or not any(ai_fields.values()):
+        from_gemini = bool(ai_fields) and any(ai_fields.values())
+        if not from_gemini:
             logger.warning("⚠️ Gemini extraction failed, using regex fallback")
             
-            company = re.search(r'(?:株式|有限)会社[^\s　\n]+', text)
-            amount_total = re.search(r"(?:合計|ご請求金額|総額)[^\d¥￥]*[¥￥]?\s*([\d,]+)", text)
-            amount_subtotal = re.search(r"(?:小計|税抜金額)[^\d¥￥]*[¥￥]?\s*([\d,]+)", text)
-            due = re.search(r"(?:支払期限|お支払期日|入金期日)[^\d]*(\d{4})[年/.\-](\d{1,2})[月/.\-](\d{1,2})", text)
-
-            if company:
-                ai_fields["vendor"] = company.group(0)
-            if amount_subtotal:
-                val = _to_decimal(amount_subtotal.group(1))
-                ai_fields["subtotal"] = float(val) if val else None
-            if amount_total:
-                val = _to_decimal(amount_total.group(1))
-                ai_fields["total"] = float(val) if val else None
-            if due:
-                y, mo, d = map(int, due.groups())
-                ai_fields["due_date"] = datetime(y, mo, d).date().isoformat()
+            found = {}
+            for m in _FALLBACK_RE.finditer(text):
+                key = m.lastgroup
+                if key in found:
+                    continue
+                found[key] = m
+                if len(found) == 4:
+                    break
+
+            if "vendor" in found:
+                ai_fields["vendor"] = found["vendor"].group("vendor")
+            if "subtotal" in found:
+                ai_fields["subtotal"] = _to_amount(found["subtotal"].group("subtotal_amount"))
+            if "total" in found:
+                ai_fields["total"] = _to_amount(found["total"].group("total_amount"))
+            if "due_date" in found:
+                due = found["due_date"]
+                y, mo, d = map(int, due.group("due_y", "due_m", "due_d"))
+                # 暦として不正な日付（2/30 など）は due_date のみ捨てる
+                # （kintone 側の validate_date でレコード全体がエラーにならないように）
+                try:
+                    ai_fields["due_date"] = date(y, mo, d).isoformat()
+                except ValueError:
+                    pass
 
         # === 結果統合 & 正規化 ===
         vendor_raw = ai_fields.get("vendor")
@@ -154,8 +280,60 @@ def extract_with_gemini(text: str, project_id: str) -> dict:
 
     except Exception as e:
         logger.error(f"❌ Gemini extraction error: {e}", exc_info=True)
+        from_gemini = False
 
-    return fields
+    return fields, from_gemini
+
+
+# ==== Document AI クライアント（ウォームインスタンスで再利用） ====
+@functools.lru_cache(maxsize=1)
+def _get_docai_client(location: str) -> documentai.DocumentProcessorServiceClient:
+    """Document AI クライアント取得（gRPC チャネルを使い回す）"""
+    logger.info(f"🔧 Document AI クライアント初期化: {location}")
+    return documentai.DocumentProcessorServiceClient(
+        client_options=ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_processor_name(project_id: str, location: str, processor_id: str) -> str:
+    """プロセッサのリソース名（コンテナの生存期間中は不変）"""
+    return documentai.DocumentProcessorServiceClient.processor_path(
+        project_id, location, processor_id
+    )
+
+
+# ==== ワーカー起動後のウォームアップ ====
+# ウォームアップ RPC のタイムアウト（秒）
+WARM_UP_TIMEOUT = 5.0
+
+
+def warm_up() -> None:
+    """
+    Document AI の gRPC チャネルと Gemini モデルを事前に初期化する
+    DNS 解決・TLS ハンドシェイク・vertexai.init を済ませ、最初の請求書の待ち時間を減らす
+    作成したクライアントを使うプロセス（fork 後のワーカー）内で呼び出すこと
+    失敗しても本処理には影響させない（Gemini の生成呼び出しは課金されるため行わない）
+    """
+    try:
+        _get_model(os.environ["GCP_PROJECT_ID"])
+        logger.info("🔥 Gemini ウォームアップ完了")
+    except Exception as e:
+        logger.warning(f"⚠️ Gemini ウォームアップ失敗: {e}")
+
+    try:
+        project_id = os.environ["GCP_PROJECT_ID"]
+        location = os.environ.get("DOCAI_LOCATION", "us")
+        processor_id = os.environ["DOCAI_PROCESSOR_ID"]
+        # 起動を長く止めないよう、リトライせず短いタイムアウトで打ち切る
+        _get_docai_client(location).get_processor(
+            name=_get_processor_name(project_id, location, processor_id),
+            retry=None,
+            timeout=WARM_UP_TIMEOUT,
+        )
+        logger.info("🔥 Document AI ウォームアップ完了")
+    except Exception as e:
+        logger.warning(f"⚠️ Document AI ウォームアップ失敗: {e}")
 
 
 # ==== PDFをDocument AIで解析 ====
@@ -163,32 +341,44 @@ def process_pdf(bucket_name: str, blob_name: str) -> dict:
     """GCSからPDFを取得してDocument AIに送信、Geminiで抽出"""
     logger.info(f"Processing PDF: gs://{bucket_name}/{blob_name}")
 
+    # 処理元情報（成功・失敗どちらの結果にも付与する）
+    source = {"bucket": bucket_name, "name": blob_name}
+
     try:
         # クライアント初期化
-        storage_client = storage.Client()
         project_id = os.environ["GCP_PROJECT_ID"]
         location = os.environ.get("DOCAI_LOCATION", "us")
         processor_id = os.environ["DOCAI_PROCESSOR_ID"]
+        source.update({"processor_id": processor_id, "location": location})
         
-        docai_client = documentai.DocumentProcessorServiceClient(
-            client_options=ClientOptions(api_endpoint=f"{location}-documentai.googleapis.com")
-        )
-
-        # GCSからPDFダウンロード
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(blob_name)
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-            blob.download_to_filename(tmp.name)
-            pdf_path = tmp.name
+        docai_client = _get_docai_client(location)
 
         # Document AI呼び出し（OCRのみ）
-        processor_name = docai_client.processor_path(project_id, location, processor_id)
+        processor_name = _get_processor_name(project_id, location, processor_id)
         logger.info(f"🔧 Using processor: {processor_name}")
-        
-        with open(pdf_path, "rb") as f:
-            raw_document = documentai.RawDocument(content=f.read(), mime_type="application/pdf")
-        
-        result = docai_client.process_document(request={"name": processor_name, "raw_document": raw_document})
+
+        # 後続処理で使うのは doc.text のみなので、レスポンスもテキスト層に限定する
+        # （ページ・ブロック・座標などのレイアウト情報の転送とデコードを省く）
+        request = {
+            "name": processor_name,
+            "field_mask": field_mask_pb2.FieldMask(paths=["text"]),
+        }
+
+        if os.environ.get("DOCAI_READ_FROM_GCS", "").lower() == "true":
+            # Document AI が GCS から直接読み込む（本関数では PDF をダウンロードしない）
+            # ※ Document AI サービスエージェントに入力バケットの読み取り権限が必要
+            request["gcs_document"] = documentai.GcsDocument(
+                gcs_uri=f"gs://{bucket_name}/{blob_name}",
+                mime_type="application/pdf",
+            )
+        else:
+            # 一時ファイルを経由せずメモリ上のバイト列をそのまま Document AI に渡す
+            pdf_bytes = get_bucket(bucket_name).blob(blob_name).download_as_bytes()
+            request["raw_document"] = documentai.RawDocument(
+                content=pdf_bytes, mime_type="application/pdf"
+            )
+
+        result = docai_client.process_document(request=request)
         doc = result.document
 
         # OCRテキスト取得
@@ -198,13 +388,8 @@ def process_pdf(bucket_name: str, blob_name: str) -> dict:
 
         # Geminiで抽出
         fields = extract_with_gemini(ocr_text, project_id)
-        fields["_source"] = {
-            "bucket": bucket_name,
-            "name": blob_name,
-            "processor_id": processor_id,
-            "location": location,
-            "status": "success"
-        }
+        source["status"] = "success"
+        fields["_source"] = source
         
         logger.info(f"✅ Extracted fields: {fields}")
         return fields
@@ -217,8 +402,7 @@ def process_pdf(bucket_name: str, blob_name: str) -> dict:
             "total": None,
             "due_date": None,
             "_source": {
-                "bucket": bucket_name,
-                "name": blob_name,
+                **source,
                 "status": "error",
                 "error_message": str(e)
             }
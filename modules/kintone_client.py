@@ -6,17 +6,42 @@ Kintone API クライアント（完全版）
 - ロギング統合
 """
 import os
-import re
 import json
 import requests
 import logging
-from typing import Dict, Any, Optional, List
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from typing import Dict, Any, Optional, List, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal, InvalidOperation
-from datetime import datetime
+from datetime import date
 
 # ロガー設定
 logger = logging.getLogger(__name__)
 
+# 一括登録 API（/k/v1/records.json）の1リクエストあたりの上限件数
+KINTONE_BULK_LIMIT = 100
+
+# HTTP タイムアウト（接続, 読み取り）秒: 接続できないエンドポイントは早めに見切る
+KINTONE_TIMEOUT = (3.05, 30)
+
+# create_records_bulk の同時リクエスト数（kintone の同時接続数制限に合わせて調整）
+KINTONE_BULK_CONCURRENCY = int(os.environ.get("KINTONE_BULK_CONCURRENCY", "8"))
+
+# 接続プールの最大接続数（一括作成のスレッド数を下回らないようにする）
+KINTONE_POOL_MAXSIZE = max(10, KINTONE_BULK_CONCURRENCY)
+
+# 一時的な障害（接続失敗・429・5xx）のリトライ設定
+# POST はデフォルトの allowed_methods に含まれないため、ステータスによる再送は
+# GET / PUT のみ（レコードの二重登録を防ぐ）
+_RETRY = Retry(
+    total=3,
+    backoff_factor=0.2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    # リトライ上限後も最後のレスポンスを返し、raise_for_status でエラー詳細を解析する
+    raise_on_status=False,
+)
+
 
 # ============================================================
 # カスタム例外
@@ -50,14 +75,18 @@ def validate_amount(value: Any, field_name: str = "金額") -> Optional[float]:
         return None
     
     try:
-        # Decimal経由で精度を保つ
-        amount = float(Decimal(str(value)))
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            # 上流（pdf-processor）からは数値で届くので Decimal を経由しない
+            amount = float(value)
+        else:
+            # 文字列は Decimal経由で精度を保つ
+            amount = float(Decimal(str(value)))
         
         # 負の値チェック
         if amount < 0:
             raise ValueError(f"{field_name}が負の値です: {amount}")
         
-        logger.debug(f"{field_name}検証成功: {amount}")
+        logger.debug("%s検証成功: %s", field_name, amount)
         return amount
         
     except (InvalidOperation, ValueError) as e:
@@ -71,16 +100,16 @@ def validate_date(date_str: str) -> str:
     if not date_str:
         return ""
     
-    # YYYY-MM-DD 形式チェック
-    if not re.match(r"^\d{4}-\d{2}-\d{2}$", date_str):
+    # YYYY-MM-DD 形式チェック（桁と区切り位置のみ。数字であることは fromisoformat が保証）
+    if len(date_str) != 10 or date_str[4] != "-" or date_str[7] != "-":
         raise ValueError(
             f"日付形式が不正です（YYYY-MM-DD形式である必要があります）: {date_str}"
         )
     
-    # 日付の妥当性チェック
+    # 日付の妥当性チェック（strptime より高速な fromisoformat を使用。数字以外は ValueError）
     try:
-        datetime.strptime(date_str, "%Y-%m-%d")
-        logger.debug(f"日付検証成功: {date_str}")
+        date.fromisoformat(date_str)
+        logger.debug("日付検証成功: %s", date_str)
     except ValueError as e:
         raise ValueError(f"日付が不正です: {date_str} ({str(e)})")
     
@@ -135,9 +164,12 @@ class KintoneClient:
         self.api_token = api_token or os.environ.get("KINTONE_API_TOKEN")
         
         # デバッグ: 環境変数の読み込み状況を確認
-        logger.debug(f"環境変数読み込み: KINTONE_DOMAIN={self.domain}")
-        logger.debug(f"環境変数読み込み: KINTONE_APP_ID={self.app_id}")
-        logger.debug(f"環境変数読み込み: KINTONE_API_TOKEN={'*' * (len(self.api_token) if self.api_token else 0)}文字")
+        logger.debug("環境変数読み込み: KINTONE_DOMAIN=%s", self.domain)
+        logger.debug("環境変数読み込み: KINTONE_APP_ID=%s", self.app_id)
+        logger.debug(
+            "環境変数読み込み: KINTONE_API_TOKEN=%d文字",
+            len(self.api_token) if self.api_token else 0
+        )
         
         if not all([self.domain, self.app_id, self.api_token]):
             missing = []
@@ -153,10 +185,29 @@ class KintoneClient:
             "Content-Type": "application/json"
         }
         
+        # Keep-Alive で TCP/TLS 接続を使い回すセッション
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_maxsize=KINTONE_POOL_MAXSIZE, max_retries=_RETRY)
+        )
+        
         logger.info(
-            f"KintoneClient初期化: domain={self.domain}, app_id={self.app_id}, token_length={len(self.api_token)}"
+            "KintoneClient初期化: domain=%s, app_id=%s, token_length=%d",
+            self.domain, self.app_id, len(self.api_token)
         )
     
+    def close(self) -> None:
+        """セッションを閉じ、プール中の接続を解放"""
+        self.session.close()
+    
+    def __enter__(self) -> "KintoneClient":
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+    
     def validate_record_data(self, data: Dict[str, Any]) -> Dict[str, Any]:
         """
         レコードデータを検証
@@ -215,7 +266,7 @@ class KintoneClient:
                 logger.error(error_message)
                 raise KintoneValidationError(error_message)
             
-            logger.debug(f"バリデーション成功: {validated}")
+            logger.debug("バリデーション成功: %s", validated)
             return validated
             
         except Exception as e:
@@ -225,26 +276,49 @@ class KintoneClient:
             logger.error(error_message)
             raise KintoneValidationError(error_message)
     
-    def create_record(self, data: Dict[str, Any]) -> int:
+    def validate_batch(
+        self,
+        records: List[Dict[str, Any]]
+    ) -> Tuple[List[Tuple[int, Dict[str, Any], Dict[str, Any]]], List[Dict[str, Any]]]:
         """
-        レコードを作成（バリデーション付き）
+        複数レコードをまとめて検証（API 呼び出し前の事前フィルタ）
         
         Args:
-            data: レコードデータ
+            records: レコードデータのリスト
             
         Returns:
-            作成されたレコードID
-            
-        Raises:
-            KintoneValidationError: バリデーションエラー
-            KintoneAPIError: API呼び出しエラー
+            (valid, invalid)
+            - valid: (index, 元データ, 検証済みデータ) のリスト
+            - invalid: {"index", "error", "data"} のリスト（create_records_bulk の failed と同じ形式）
+            index は1始まりの入力順
         """
-        # 1. データ検証
-        validated_data = self.validate_record_data(data)
+        valid = []
+        invalid = []
+        validate = self.validate_record_data
         
-        # 2. Kintone API用のペイロード作成
-        url = f"{self.domain}/k/v1/record.json"
+        for idx, data in enumerate(records, 1):
+            try:
+                valid.append((idx, data, validate(data)))
+            except KintoneValidationError as e:
+                invalid.append({
+                    "index": idx,
+                    "error": str(e),
+                    "data": data
+                })
+        
+        return valid, invalid
+    
+    @staticmethod
+    def _build_record(validated_data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        検証済みデータから Kintone API 用のレコードを構築
         
+        Args:
+            validated_data: validate_record_data の戻り値
+            
+        Returns:
+            Kintone レコード（{"フィールドコード": {"value": 値}}）
+        """
         # レコード構築（Noneの場合はフィールドを含めない）
         record = {
             "vendor": {"value": validated_data.get("vendor", "")}
@@ -261,17 +335,41 @@ class KintoneClient:
         if validated_data.get("due_date"):
             record["due_date"] = {"value": validated_data["due_date"]}
         
+        return record
+    
+    def create_record(self, data: Dict[str, Any]) -> int:
+        """
+        レコードを作成（バリデーション付き）
+        
+        Args:
+            data: レコードデータ
+            
+        Returns:
+            作成されたレコードID
+            
+        Raises:
+            KintoneValidationError: バリデーションエラー
+            KintoneAPIError: API呼び出しエラー
+        """
+        # 1. データ検証
+        validated_data = self.validate_record_data(data)
+        
+        # 2. Kintone API用のペイロード作成
+        url = f"{self.domain}/k/v1/record.json"
+        
         payload = {
             "app": self.app_id,
-            "record": record
+            "record": self._build_record(validated_data)
         }
         
-        logger.info(f"📤 Kintone API呼び出し: POST {url}")
-        logger.info(f"📦 送信ペイロード: {json.dumps(payload, ensure_ascii=False, indent=2)}")
+        logger.info("📤 Kintone API呼び出し: POST %s", url)
+        # ペイロードの JSON 化は DEBUG 有効時のみ行う
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("📦 送信ペイロード: %s", json.dumps(payload, ensure_ascii=False))
         
         # 3. API呼び出し
         try:
-            response = requests.post(url, headers=self.headers, json=payload, timeout=30)
+            response = self.session.post(url, json=payload, timeout=KINTONE_TIMEOUT)
             response.raise_for_status()
             
             result = response.json()
@@ -280,7 +378,7 @@ class KintoneClient:
             if not record_id:
                 raise KintoneAPIError("レコードIDが返されませんでした")
             
-            logger.info(f"✅ レコード作成成功: ID={record_id}")
+            logger.info("✅ レコード作成成功: ID=%s", record_id)
             return int(record_id)
             
         except requests.exceptions.HTTPError as e:
@@ -301,7 +399,67 @@ class KintoneClient:
             raise KintoneAPIError(full_error_message)
             
         except requests.exceptions.Timeout:
-            error_message = "Kintone APIタイムアウト（30秒）"
+            error_message = f"Kintone APIタイムアウト（接続/読み取り: {KINTONE_TIMEOUT}秒）"
+            logger.error(error_message)
+            raise KintoneAPIError(error_message)
+            
+        except requests.exceptions.RequestException as e:
+            error_message = f"Kintone API接続エラー: {str(e)}"
+            logger.error(error_message)
+            raise KintoneAPIError(error_message)
+    
+    def _create_records_chunk(self, validated_chunk: List[Dict[str, Any]]) -> List[int]:
+        """
+        検証済みレコードを /k/v1/records.json に1リクエストで登録（最大 KINTONE_BULK_LIMIT 件）
+        
+        Args:
+            validated_chunk: validate_record_data の戻り値のリスト
+            
+        Returns:
+            作成されたレコードIDのリスト（入力順）
+            
+        Raises:
+            KintoneAPIError: API呼び出しエラー（リクエスト内の全件が未登録）
+        """
+        url = f"{self.domain}/k/v1/records.json"
+        payload = {
+            "app": self.app_id,
+            "records": [self._build_record(v) for v in validated_chunk]
+        }
+        
+        logger.info("📤 Kintone API呼び出し: POST %s (%d件)", url, len(validated_chunk))
+        
+        try:
+            response = self.session.post(url, json=payload, timeout=KINTONE_TIMEOUT)
+            response.raise_for_status()
+            
+            ids = response.json().get("ids", [])
+            if len(ids) != len(validated_chunk):
+                raise KintoneAPIError(
+                    f"レコードIDの数が一致しません: 送信={len(validated_chunk)}, 返却={len(ids)}"
+                )
+            
+            logger.info("✅ 一括レコード作成成功: %d件", len(ids))
+            return [int(record_id) for record_id in ids]
+            
+        except requests.exceptions.HTTPError as e:
+            try:
+                error_detail = response.json()
+                error_message = error_detail.get("message", str(e))
+                error_code = error_detail.get("code", "UNKNOWN")
+            except:
+                error_message = str(e)
+                error_code = "UNKNOWN"
+            
+            full_error_message = (
+                f"Kintone APIエラー [{error_code}]: {error_message}\n"
+                f"ステータスコード: {response.status_code}"
+            )
+            logger.error(full_error_message)
+            raise KintoneAPIError(full_error_message)
+            
+        except requests.exceptions.Timeout:
+            error_message = f"Kintone APIタイムアウト（接続/読み取り: {KINTONE_TIMEOUT}秒）"
             logger.error(error_message)
             raise KintoneAPIError(error_message)
             
@@ -314,6 +472,11 @@ class KintoneClient:
         """
         複数レコードを一括作成（エラーハンドリング付き）
         
+        検証を通ったレコードを /k/v1/records.json で100件ずつまとめて送信し、
+        各リクエストを KINTONE_BULK_CONCURRENCY 並列で実行する。
+        一括登録はリクエスト単位でアトミックなため、API エラー時はそのリクエストに
+        含まれる全件を失敗として返す。結果は成功・失敗とも入力順（index 昇順）。
+        
         Args:
             records: レコードデータのリスト
             
@@ -328,36 +491,61 @@ class KintoneClient:
             "failed_count": 0
         }
         
-        logger.info(f"一括レコード作成開始: {len(records)}件")
+        logger.info("一括レコード作成開始: %d件", len(records))
         
-        for idx, data in enumerate(records, 1):
-            try:
-                record_id = self.create_record(data)
-                results["success"].append({
-                    "index": idx,
-                    "record_id": record_id,
-                    "data": data
-                })
-                results["success_count"] += 1
-                
-                logger.info(
-                    f"✅ [{idx}/{len(records)}] レコード作成成功: "
-                    f"ID={record_id}, ベンダー={data.get('vendor')}"
-                )
-                
-            except (KintoneValidationError, KintoneAPIError) as e:
-                results["failed"].append({
-                    "index": idx,
-                    "error": str(e),
-                    "data": data
-                })
-                results["failed_count"] += 1
+        # 1. 全件検証（不正なレコードだけを失敗扱いにし、残りは送信する）
+        valid, invalid = self.validate_batch(records)
+        for failed in invalid:
+            logger.error(
+                "❌ [%d/%d] レコード作成失敗: %s",
+                failed["index"], len(records), failed["error"]
+            )
+        results["failed"].extend(invalid)
+        
+        # 2. 100件ずつまとめて並列送信
+        chunks = [
+            valid[start:start + KINTONE_BULK_LIMIT]
+            for start in range(0, len(valid), KINTONE_BULK_LIMIT)
+        ]
+        
+        with ThreadPoolExecutor(max_workers=KINTONE_BULK_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(self._create_records_chunk, [v for _, _, v in chunk]): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    record_ids = future.result()
+                except KintoneAPIError as e:
+                    for idx, data, _ in chunk:
+                        results["failed"].append({
+                            "index": idx,
+                            "error": str(e),
+                            "data": data
+                        })
+                    logger.error(
+                        "❌ [%d-%d/%d] 一括レコード作成失敗: %s",
+                        chunk[0][0], chunk[-1][0], len(records), e
+                    )
+                    continue
                 
-                logger.error(f"❌ [{idx}/{len(records)}] レコード作成失敗: {str(e)}")
+                for (idx, data, _), record_id in zip(chunk, record_ids):
+                    results["success"].append({
+                        "index": idx,
+                        "record_id": record_id,
+                        "data": data
+                    })
+        
+        # as_completed は完了順なので入力順に並べ直す
+        results["success"].sort(key=lambda r: r["index"])
+        results["failed"].sort(key=lambda r: r["index"])
+        results["success_count"] = len(results["success"])
+        results["failed_count"] = len(results["failed"])
         
         logger.info(
-            f"一括レコード作成完了: 成功={results['success_count']}, "
-            f"失敗={results['failed_count']}"
+            "一括レコード作成完了: 成功=%d, 失敗=%d",
+            results["success_count"], results["failed_count"]
         )
         
         return results
@@ -379,32 +567,18 @@ class KintoneClient:
         
         url = f"{self.domain}/k/v1/record.json"
         
-        # レコード構築（Noneの場合はフィールドを含めない）
-        record = {
-            "vendor": {"value": validated_data.get("vendor", "")}
-        }
-        
-        if validated_data.get("subtotal") is not None:
-            record["subtotal"] = {"value": str(validated_data["subtotal"])}
-        
-        if validated_data.get("total") is not None:
-            record["total"] = {"value": str(validated_data["total"])}
-        
-        if validated_data.get("due_date"):
-            record["due_date"] = {"value": validated_data["due_date"]}
-        
         payload = {
             "app": self.app_id,
             "id": record_id,
-            "record": record
+            "record": self._build_record(validated_data)
         }
         
-        logger.debug(f"レコード更新: ID={record_id}")
+        logger.debug("レコード更新: ID=%s", record_id)
         
         try:
-            response = requests.put(url, headers=self.headers, json=payload, timeout=30)
+            response = self.session.put(url, json=payload, timeout=KINTONE_TIMEOUT)
             response.raise_for_status()
-            logger.info(f"✅ レコード更新成功: ID={record_id}")
+            logger.info("✅ レコード更新成功: ID=%s", record_id)
             
         except requests.exceptions.HTTPError as e:
             try:
@@ -441,13 +615,13 @@ class KintoneClient:
             "id": record_id
         }
         
-        logger.debug(f"レコード取得: ID={record_id}")
+        logger.debug("レコード取得: ID=%s", record_id)
         
         try:
-            response = requests.get(url, headers=self.headers, params=params, timeout=30)
+            response = self.session.get(url, params=params, timeout=KINTONE_TIMEOUT)
             response.raise_for_status()
             
-            logger.info(f"✅ レコード取得成功: ID={record_id}")
+            logger.info("✅ レコード取得成功: ID=%s", record_id)
             return response.json().get("record", {})
             
         except requests.exceptions.HTTPError as e:
@@ -485,9 +659,6 @@ if __name__ == "__main__":
     load_dotenv()
     
     try:
-        # クライアント初期化
-        client = KintoneClient()
-        
         # テストデータ
         test_records = [
             {
@@ -515,7 +686,9 @@ if __name__ == "__main__":
         print("一括レコード作成を開始します...")
         print("=" * 60 + "\n")
         
-        results = client.create_records_bulk(test_records)
+        # クライアント初期化（終了時にセッションを閉じる）
+        with KintoneClient() as client:
+            results = client.create_records_bulk(test_records)
         
         # 結果サマリー
         print("\n" + "=" * 60)
@@ -536,5 +709,5 @@ if __name__ == "__main__":
                 print(f"  [{success['index']}] レコードID: {success['record_id']}")
     
     except Exception as e:
-        logger.error(f"テスト実行エラー: {str(e)}", exc_info=True)
+        logger.error("テスト実行エラー: %s", e, exc_info=True)
         sys.exit(1)
\ No newline at end of file
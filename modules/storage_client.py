@@ -0,0 +1,37 @@
+"""
+GCS クライアント共有モジュール
+- storage.Client をプロセス内で使い回す（コネクション・認証トークンを再利用）
+- Bucket ハンドルをバケット名ごとにキャッシュ
+"""
+import functools
+import logging
+from google.cloud import storage
+
+# ロガー設定
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=1)
+def get_storage_client() -> storage.Client:
+    """
+    GCS クライアント取得（ウォームインスタンスでは初回生成分を再利用）
+
+    Returns:
+        storage.Client
+    """
+    logger.info("GCS クライアント初期化")
+    return storage.Client()
+
+
+@functools.lru_cache(maxsize=8)
+def get_bucket(bucket_name: str) -> storage.Bucket:
+    """
+    Bucket ハンドル取得（バケット名ごとにキャッシュ）
+
+    Args:
+        bucket_name: バケット名
+
+    Returns:
+        storage.Bucket
+    """
+    return get_storage_client().bucket(bucket_name)
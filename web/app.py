@@ -1,6 +1,7 @@
 import os
 import uuid
 import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from flask import Flask, request, jsonify
 from google.cloud import storage
 from werkzeug.utils import secure_filename
@@ -11,6 +12,21 @@ app = Flask(__name__, static_folder='static', static_url_path='')
 PROJECT_ID = os.environ.get('GOOGLE_CLOUD_PROJECT_ID')
 INPUT_BUCKET = os.environ.get('INPUT_BUCKET')
 
+# === アップロード設定 ===
+# ハッシュ計算時の読み込み単位（ファイル全体をメモリに載せない）
+HASH_CHUNK_SIZE = 1024 * 1024
+# GCS 再開可能アップロードのチャンクサイズ（256KB の倍数である必要あり）
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# 1リクエスト内で並列にアップロードするファイル数
+UPLOAD_MAX_WORKERS = 4
+# PDF のマジックバイト（拡張子ではなく中身で判定する）
+PDF_MAGIC = b'%PDF-'
+# リクエスト全体の上限（超過分は GCS に触れる前に WSGI 層で 413 を返す）
+# Cloud Run の HTTP/1 リクエスト上限（32MiB、ヘッダー込み）より小さくし、
+# アプリ側の JSON 413 が返るようにする
+MAX_UPLOAD_MB = 30
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+
 # 必須環境変数のチェック
 if not PROJECT_ID or not INPUT_BUCKET:
     raise ValueError(
@@ -23,6 +39,59 @@ def get_storage_client():
     """GCS クライアント取得"""
     return storage.Client(project=PROJECT_ID)
 
+def upload_pdf(bucket, file, file_hash, file_size):
+    """
+    ハッシュ名で GCS に PDF をアップロード（既存なら重複として返す）
+    
+    Returns:
+        ('uploaded' | 'duplicate', レスポンス用の情報)
+    """
+    # ハッシュベースのファイル名を生成
+    save_filename = f"{file_hash}.pdf"
+    
+    # GCS上での重複チェック
+    blob = bucket.blob(save_filename)
+    
+    if blob.exists():
+        # 重複検知: 既にアップロード済み
+        app.logger.warning(f"Duplicate detected: {file.filename} (hash: {file_hash[:8]}...)")
+        return 'duplicate', {
+            'original_name': file.filename,
+            'status': 'duplicate',
+            'message': '既にアップロード済みのファイルです'
+        }
+    
+    # 重複なし → アップロード実行
+    # メタデータに元のファイル名を保存
+    blob.metadata = {
+        'original_filename': file.filename,
+        'file_hash': file_hash,
+        'upload_timestamp': str(uuid.uuid4())  # アップロード識別用
+    }
+    # ストリームから直接アップロード（大きなファイルはチャンク分割）
+    blob.chunk_size = UPLOAD_CHUNK_SIZE
+    blob.upload_from_file(
+        file.stream,
+        content_type='application/pdf',
+        size=file_size
+    )
+    
+    app.logger.info(f"Uploaded: {save_filename} (original: {file.filename})")
+    return 'uploaded', {
+        'original_name': file.filename,
+        'uploaded_name': save_filename,
+        'file_hash': file_hash[:8],  # 先頭8文字のみ表示
+        'size': file_size
+    }
+
+@app.errorhandler(413)
+def request_entity_too_large(e):
+    """アップロードサイズ超過"""
+    return jsonify({
+        'success': False,
+        'message': f'ファイルサイズが大きすぎます（合計{MAX_UPLOAD_MB}MBまで）'
+    }), 413
+
 @app.route('/', methods=['GET'])
 def index():
     """トップページ"""
@@ -51,53 +120,51 @@ def upload_files():
     uploaded_files = []
     failed_files = []
     duplicate_files = []
+    # 中身が PDF でないため受け付けなかったファイル数（クライアント側の誤り）
+    rejected_count = 0
 
     try:
         storage_client = get_storage_client()
         bucket = storage_client.bucket(INPUT_BUCKET)
         
+        # 1. 内容チェックとハッシュ計算（ローカル処理のため逐次実行）
+        pending = []
+        seen_hashes = set()
         for file in pdf_files:
             try:
-                # 1. ファイルハッシュを計算（重複チェック用）
-                file_content = file.read()
-                file_hash = hashlib.sha256(file_content).hexdigest()
-                
-                # ※重要: read()後はファイル位置を先頭に戻す
-                file.seek(0)
+                # 中身が PDF かをマジックバイトで確認（拡張子偽装を弾く）
+                head = file.stream.read(len(PDF_MAGIC))
+                file.stream.seek(0)
+                if head != PDF_MAGIC:
+                    app.logger.warning(f"Rejected non-PDF content: {file.filename}")
+                    rejected_count += 1
+                    failed_files.append({
+                        'filename': file.filename,
+                        'error': 'PDFファイルではありません'
+                    })
+                    continue
                 
-                # 2. ハッシュベースのファイル名を生成
-                save_filename = f"{file_hash}.pdf"
+                # ファイルハッシュを計算（重複チェック用）
+                # チャンク単位で読み込み、ファイル全体をメモリに展開しない
+                hasher = hashlib.sha256()
+                for chunk in iter(lambda: file.stream.read(HASH_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+                file_hash = hasher.hexdigest()
+                file_size = file.stream.tell()
                 
-                # 3. GCS上での重複チェック
-                blob = bucket.blob(save_filename)
+                # ※重要: read()後はファイル位置を先頭に戻す
+                file.stream.seek(0)
                 
-                if blob.exists():
-                    # 重複検知: 既にアップロード済み
-                    app.logger.warning(f"Duplicate detected: {file.filename} (hash: {file_hash[:8]}...)")
+                # 同一リクエスト内の重複（並列アップロードで二重登録しないよう先に除外）
+                if file_hash in seen_hashes:
                     duplicate_files.append({
                         'original_name': file.filename,
                         'status': 'duplicate',
-                        'message': '既にアップロード済みのファイルです'
+                        'message': '同じファイルが複数選択されています'
                     })
-                    continue  # 次のファイルへ
-                
-                # 4. 重複なし → アップロード実行
-                # メタデータに元のファイル名を保存
-                blob.metadata = {
-                    'original_filename': file.filename,
-                    'file_hash': file_hash,
-                    'upload_timestamp': str(uuid.uuid4())  # アップロード識別用
-                }
-                blob.upload_from_string(file_content, content_type='application/pdf')
-                
-                uploaded_files.append({
-                    'original_name': file.filename,
-                    'uploaded_name': save_filename,
-                    'file_hash': file_hash[:8],  # 先頭8文字のみ表示
-                    'size': len(file_content)
-                })
-                
-                app.logger.info(f"Uploaded: {save_filename} (original: {file.filename})")
+                    continue
+                seen_hashes.add(file_hash)
+                pending.append((file, file_hash, file_size))
                 
             except Exception as e:
                 app.logger.error(f"Upload failed for {file.filename}: {e}")
@@ -106,6 +173,28 @@ def upload_files():
                     'error': str(e)
                 })
         
+        # 2. GCS への重複チェック＋アップロード（I/O 待ちのためファイル単位で並列実行）
+        with ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+            futures = [
+                executor.submit(upload_pdf, bucket, file, file_hash, file_size)
+                for file, file_hash, file_size in pending
+            ]
+            for (file, _, _), future in zip(pending, futures):
+                try:
+                    status, info = future.result()
+                except Exception as e:
+                    app.logger.error(f"Upload failed for {file.filename}: {e}")
+                    failed_files.append({
+                        'filename': file.filename,
+                        'error': str(e)
+                    })
+                    continue
+                
+                if status == 'duplicate':
+                    duplicate_files.append(info)
+                else:
+                    uploaded_files.append(info)
+        
         # レスポンス作成
         total_processed = len(uploaded_files) + len(duplicate_files) + len(failed_files)
         
@@ -116,6 +205,13 @@ def upload_files():
                 'message': f'✅ {len(uploaded_files)}個のファイルをアップロードしました\nKintoneに反映されるまで1分程お待ちください。',
                 'uploaded': uploaded_files
             }), 200
+        elif len(uploaded_files) == 0 and len(duplicate_files) == 0 and rejected_count == len(failed_files):
+            # 全て PDF 以外（リクエスト側の誤り）
+            return jsonify({
+                'success': False,
+                'message': 'PDFファイルではありません',
+                'failed': failed_files
+            }), 400
         elif len(uploaded_files) == 0 and len(duplicate_files) == 0:
             # 全て失敗
             return jsonify({